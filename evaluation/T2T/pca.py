@@ -1,6 +1,5 @@
+import numpy as np
 import pandas as pd
-from sklearn.preprocessing import StandardScaler
-from sklearn.decomposition import PCA
 
 # laod csv
 df_faith = pd.read_csv('ds_sucks.csv')
@@ -17,30 +16,23 @@ rich_cols = [
     'noun_ratio_diff', 'verb_ratio_diff', 'ner_diff'
 ]
 
-# standardisation before pca (fauthfulness)
-scaler_f = StandardScaler()
-X_f = scaler_f.fit_transform(df_faith[faith_cols].dropna())
-pca_f = PCA(n_components=1)
-pca_f.fit(X_f)
-
-loadings_f = pd.Series(
-    pca_f.components_[0],
-    index=faith_cols
-).abs().sort_values(ascending=False)
-
+# standardisation then pca; PC1 is the eigenvector of the (symmetric) covariance
+# matrix with the largest eigenvalue, so eigh returns it as the last column
+def top_pc_loadings(df, cols):
+    X = df[cols].to_numpy(dtype=np.float64, copy=False)
+    # same rows as dropna(); the mask copies, so X can be scaled in place
+    X = X[~np.isnan(X).any(axis=1)]
+    X -= X.mean(0)
+    std = X.std(0)
+    std[std == 0] = 1  # constant columns keep scale 1, as in StandardScaler
+    X /= std
+    _, V = np.linalg.eigh(X.T @ X)
+    return pd.Series(np.abs(V[:, -1]), index=cols).sort_values(ascending=False)
+
+loadings_f = top_pc_loadings(df_faith, faith_cols)
 print("Faithfulness PC1 loadings (abs):")
 print(loadings_f)
 
-# standardisation before pca (richness)
-scaler_r = StandardScaler()
-X_r = scaler_r.fit_transform(df_rich[rich_cols].dropna())
-pca_r = PCA(n_components=1)
-pca_r.fit(X_r)
-
-loadings_r = pd.Series(
-    pca_r.components_[0],
-    index=rich_cols
-).abs().sort_values(ascending=False)
-
+loadings_r = top_pc_loadings(df_rich, rich_cols)
 print("\nRichness PC1 loadings (abs):")
-print(loadings_r)
\ No newline at end of file
+print(loadings_r)
@@ -4,118 +4,365 @@ caption_enhanced_images.py
 Purpose:
 This script loops through the four model folders (T5, BART, QWEN, DEEPSEEK),
 reads each generated image and enhanced prompt, and generates a caption using GPT-4o-mini.
+Captions are requested through the OpenAI Batch API by default (set `use_batch_api = False`
+to caption interactively with concurrent requests instead).
 Each model's results are saved in a sorted CSV for evaluation and comparison.
 """
 
 import os
-import openai
+import csv
+import json
+import hashlib
+import asyncio
+import shelve
 import pandas as pd
-from PIL import Image
+from PIL import Image, UnidentifiedImageError
 import base64
 from io import BytesIO
 from dotenv import load_dotenv
 from tqdm import tqdm
-import time
+from openai import AsyncOpenAI, APIError, APIConnectionError, InternalServerError, RateLimitError
 
 # === STEP 1: Configuration ===
 # Set environment, API key, folder paths, and filenames
 load_dotenv()
-openai.api_key = os.getenv("OPENAI_API_KEY")
+api_key = os.getenv("OPENAI_API_KEY")
 
 base_folder = "C:/LocalRepo/captioner"
 model_folders = ["T5", "BART", "QWEN", "DEEPSEEK"]
 num_samples = 200
-save_interval = 50
+max_concurrency = 20  # Number of in-flight GPT-4o-mini requests
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, InternalServerError)  # Other API errors (4xx) fail fast
+images_per_request = 4  # Images captioned per live request, multiplying effective RPM
+use_batch_api = True  # Submit each folder as an OpenAI Batch API job (half price, completes within 24h)
+batch_poll_interval = 60  # Seconds between batch status checks
+max_batch_file_bytes = 190 * 1024 * 1024  # Kept under the Batch API's 200 MB input-file limit
 output_dir = os.path.join(base_folder, "model_outputs")
 os.makedirs(output_dir, exist_ok=True)
 
 # === STEP 2: Image captioning per model folder ===
 # For each model folder, read image + enhanced prompt, caption it with GPT-4o-mini, and save
+# Raw file bytes are sent as-is; only formats the API does not accept are re-encoded as PNG
+API_IMAGE_TYPES = {"PNG": "image/png", "JPEG": "image/jpeg", "WEBP": "image/webp"}
+
 def encode_image(image_path):
     try:
-        with Image.open(image_path) as img:
+        with open(image_path, "rb") as f:
+            data = f.read()
+        with Image.open(BytesIO(data)) as img:
+            mime_type = API_IMAGE_TYPES.get(img.format)
+            if mime_type:
+                img.verify()  # Header/chunk check only; the original bytes are sent as-is
+                return f"data:{mime_type};base64,{base64.b64encode(data).decode('utf-8')}"
+            # Formats the API does not accept are re-encoded as PNG
             img = img.convert("RGB")
             buffered = BytesIO()
             img.save(buffered, format="PNG")
-            return base64.b64encode(buffered.getvalue()).decode("utf-8")
-    except Exception as e:
+            return f"data:image/png;base64,{base64.b64encode(buffered.getvalue()).decode('utf-8')}"
+    except (UnidentifiedImageError, OSError, SyntaxError) as e:  # verify() reports broken chunks as SyntaxError
         print(f"Encoding failed: {image_path} — {e}")
         return None
 
-def get_caption_from_api(b64_image, retries=3, delay=1.5):
+# Looks up the encoded image by (filename, mtime, size) in an on-disk cache beside the images,
+# so re-running a folder after a failure does not read and encode every PNG again.
+def encode_image_cached(b64_cache, image_path):
+    stat = os.stat(image_path)
+    key = f"{os.path.basename(image_path)}|{stat.st_mtime_ns}|{stat.st_size}"
+    image_url = b64_cache.get(key)
+    if image_url is None:
+        image_url = encode_image(image_path)
+        if image_url:
+            b64_cache[key] = image_url
+    return image_url
+
+# Single-image request, the same instruction the civitai and lexica captioners use (batch path)
+def build_caption_request(image_url):
+    return {
+        "model": "gpt-4o-mini",
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": "Describe this image briefly, including the subject(s) and visual details. Use one clear sentence."},
+                    {"type": "image_url", "image_url": {"url": image_url}}
+                ]
+            }
+        ],
+        "max_tokens": 100
+    }
+
+# Several images in one request with numbered JSON captions (live path, to multiply effective RPM)
+def build_group_caption_request(image_urls):
+    return {
+        "model": "gpt-4o-mini",
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": (
+                        f"Describe each of the {len(image_urls)} images below briefly, including the subject(s) and visual details. "
+                        "Use one clear sentence per image. Return a JSON object of the form "
+                        '{"captions": ["...", ...]} with one caption per image, in the same order as the images.'
+                    )},
+                    *[{"type": "image_url", "image_url": {"url": image_url}} for image_url in image_urls]
+                ]
+            }
+        ],
+        "response_format": {"type": "json_object"},
+        "max_tokens": 100 * len(image_urls)
+    }
+
+# Returns one caption per image, or None if the reply is not the expected JSON
+def parse_captions(content, expected):
+    try:
+        captions = json.loads(content)["captions"]
+    except (json.JSONDecodeError, KeyError, TypeError):
+        return None
+    if not isinstance(captions, list) or len(captions) != expected:
+        return None
+    return [str(caption).strip() for caption in captions]
+
+async def get_caption_from_api(client, sem, image_urls, retries=3, delay=1):
+    async with sem:
+        for attempt in range(retries):
+            try:
+                response = await client.chat.completions.create(**build_group_caption_request(image_urls))
+                captions = parse_captions(response.choices[0].message.content, len(image_urls))
+                if captions is not None:
+                    return captions
+                print(f"Attempt {attempt+1} returned malformed captions")
+            except RETRYABLE_ERRORS as e:
+                print(f"Attempt {attempt+1} failed: {e}")
+            except APIError as e:
+                print(f"Request rejected: {e}")
+                break
+            if attempt + 1 < retries:
+                await asyncio.sleep(delay * 2 ** attempt)  # Backoff: 1s, 2s
+    return [""] * len(image_urls)
+
+async def caption_group(client, sem, group):
+    captions = await get_caption_from_api(client, sem, [image_url for _, image_url in group])
+    return [(record, caption) for (record, _), caption in zip(group, captions)]
+
+# Live path: one chat-completions request per group of images, yielded as each request finishes
+async def caption_live(client, model_name, pending):
+    sem = asyncio.Semaphore(max_concurrency)
+    groups = [pending[i:i + images_per_request] for i in range(0, len(pending), images_per_request)]
+    tasks = [caption_group(client, sem, group) for group in groups]
+    for task in tqdm(asyncio.as_completed(tasks), desc=f"Processing {model_name}", total=len(tasks)):
+        for record, caption in await task:
+            if caption == "":
+                print(f"[{record['id']}] Failed after retries.")
+            yield record, caption
+
+# Batch path: upload the requests as JSONL input files, poll until the jobs finish, then read the results back
+def write_batch_files(model_name, pending):
+    # Requests are split across several input files when one would exceed the Batch API's file size limit
+    paths = []
+    f = None
+    size = 0
+    for record, image_url in pending:
+        line = (json.dumps({
+            "custom_id": str(record["id"]),
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": build_caption_request(image_url)
+        }) + "\n").encode("utf-8")
+        if f is None or size + len(line) > max_batch_file_bytes:
+            if f is not None:
+                f.close()
+            paths.append(os.path.join(output_dir, f"{model_name}_batch_input_{len(paths) + 1}.jsonl"))
+            f = open(paths[-1], "wb")
+            size = 0
+        f.write(line)
+        size += len(line)
+    if f is not None:
+        f.close()
+    return paths
+
+def batch_error_message(result):
+    response = result.get("response") or {}
+    error = result.get("error") or (response.get("body") or {}).get("error") or {}
+    return error.get("message") or f"HTTP {response.get('status_code')}"
+
+# Batch jobs are polled for hours, so transient errors while checking on them are retried with backoff
+async def call_with_retries(request, *args, retries=5, delay=1):
     for attempt in range(retries):
         try:
-            response = openai.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": "Describe this image briefly, including the subject(s) and visual details. Use one clear sentence."},
-                            {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{b64_image}"}}
-                        ]
-                    }
-                ],
-                max_tokens=100
-            )
-            return response.choices[0].message.content.strip()
-        except Exception as e:
+            return await request(*args)
+        except RETRYABLE_ERRORS as e:
+            if attempt + 1 == retries:
+                raise
             print(f"Attempt {attempt+1} failed: {e}")
-            time.sleep(delay * (attempt + 1))
-    return ""
+            await asyncio.sleep(delay * 2 ** attempt)
+
+# The submitted batch ID is saved beside its input file together with a hash of the requests,
+# so a re-run after a crash resumes the same job instead of paying for it again
+def batch_id_path(batch_input_path):
+    return os.path.splitext(batch_input_path)[0] + ".batch_id"
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
 
-def process_model_folder(model_name):
+def load_batch_id(batch_input_path, input_hash):
+    try:
+        with open(batch_id_path(batch_input_path), "r", encoding="utf-8") as f:
+            saved = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+    return saved.get("batch_id") if saved.get("input_sha256") == input_hash else None
+
+# Runs one batch job; returns {custom_id: caption} and {custom_id: error message}
+async def run_batch(client, model_name, batch_input_path):
+    input_hash = file_sha256(batch_input_path)
+    batch = None
+    batch_id = load_batch_id(batch_input_path, input_hash)
+    if batch_id:
+        batch = await call_with_retries(client.batches.retrieve, batch_id)
+        if batch.status in ("failed", "expired", "cancelled"):
+            print(f"Previous batch {batch.id} ended with status: {batch.status}; resubmitting")
+            batch = None
+        else:
+            print(f"Resuming batch {batch.id} ({os.path.basename(batch_input_path)}) for {model_name}")
+
+    if batch is None:
+        with open(batch_input_path, "rb") as f:
+            batch_file = await client.files.create(file=f, purpose="batch")
+        batch = await client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        with open(batch_id_path(batch_input_path), "w", encoding="utf-8") as f:
+            json.dump({"batch_id": batch.id, "input_sha256": input_hash}, f)
+        print(f"Submitted batch {batch.id} ({os.path.basename(batch_input_path)}) for {model_name}")
+
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        await asyncio.sleep(batch_poll_interval)
+        batch = await call_with_retries(client.batches.retrieve, batch.id)
+
+    if batch.status != "completed":
+        print(f"Batch {batch.id} ended with status: {batch.status}")
+
+    captions = {}
+    errors = {}
+    # Expired or cancelled batches can still carry partial output and error files
+    if batch.output_file_id:
+        output = await call_with_retries(client.files.content, batch.output_file_id)
+        for line in output.text.splitlines():
+            result = json.loads(line)
+            response = result.get("response") or {}
+            if result.get("error") or response.get("status_code") != 200:
+                errors[result["custom_id"]] = batch_error_message(result)
+                continue
+            content = response["body"]["choices"][0]["message"]["content"]
+            if content:
+                captions[result["custom_id"]] = content.strip()
+            else:
+                errors[result["custom_id"]] = "empty caption"
+    if batch.error_file_id:
+        error_output = await call_with_retries(client.files.content, batch.error_file_id)
+        for line in error_output.text.splitlines():
+            result = json.loads(line)
+            errors[result["custom_id"]] = batch_error_message(result)
+    return captions, errors
+
+async def caption_batch(client, model_name, pending):
+    if not pending:
+        return
+
+    captions = {}
+    errors = {}
+    batch_paths = write_batch_files(model_name, pending)
+    for batch_captions, batch_errors in await asyncio.gather(*[run_batch(client, model_name, path) for path in batch_paths]):
+        captions.update(batch_captions)
+        errors.update(batch_errors)
+
+    for record, _ in pending:
+        custom_id = str(record["id"])
+        if custom_id not in captions:
+            print(f"[{record['id']}] Batch request failed: {errors.get(custom_id, 'no result returned')}")
+        yield record, captions.get(custom_id, "")
+
+async def process_model_folder(model_name):
     folder_path = os.path.join(base_folder, model_name)
-    png_files = sorted([f for f in os.listdir(folder_path) if f.endswith(".png")])[:num_samples]
-    records = []
+    with os.scandir(folder_path) as it:
+        names = {entry.name for entry in it if entry.is_file()}
+    png_files = sorted(f for f in names if f.endswith(".png"))[:num_samples]
+    pending = []
 
-    for idx, fname in enumerate(tqdm(png_files, desc=f"Processing {model_name}", total=num_samples), start=1):
-        img_id = fname.replace(".png", "")
-        img_path = os.path.join(folder_path, fname)
-        txt_path = os.path.join(folder_path, f"{img_id}.txt")
+    with shelve.open(os.path.join(folder_path, ".b64cache")) as b64_cache:
+        for fname in png_files:
+            img_id = fname.replace(".png", "")
+            img_path = os.path.join(folder_path, fname)
+            txt_path = os.path.join(folder_path, f"{img_id}.txt")
 
-        if not os.path.exists(txt_path):
-            print(f"[{img_id}] Missing .txt file")
-            continue
+            if f"{img_id}.txt" not in names:
+                print(f"[{img_id}] Missing .txt file")
+                continue
 
-        try:
-            with open(txt_path, "r", encoding="utf-8") as f:
-                prompt = f.read().strip()
-        except Exception as e:
-            print(f"[{img_id}] Prompt read error: {e}")
-            continue
+            try:
+                with open(txt_path, "r", encoding="utf-8") as f:
+                    prompt = f.read().strip()
+            except (OSError, UnicodeDecodeError) as e:
+                print(f"[{img_id}] Prompt read error: {e}")
+                continue
 
-        b64_image = encode_image(img_path)
-        if not b64_image:
-            print(f"[{img_id}] Image encoding failed")
-            continue
+            image_url = encode_image_cached(b64_cache, img_path)
+            if not image_url:
+                print(f"[{img_id}] Image encoding failed")
+                continue
 
-        caption = get_caption_from_api(b64_image)
-        if caption == "":
-            print(f"[{img_id}] Failed after retries.")
-            continue
+            pending.append(({"id": int(img_id), "prompt": prompt, "image_filename": fname}, image_url))
 
-        records.append({
-            "id": int(img_id),
-            "prompt": prompt,
-            "image_filename": fname,
-            "caption": caption
-        })
+    # Each caption is appended to the temp CSV as soon as it arrives, so progress survives a crash
+    temp_path = os.path.join(output_dir, f"{model_name}_captions_temp.csv")
+    saved = 0
+    # One client (and its connection pool) is shared by every request for this model folder
+    async with AsyncOpenAI(api_key=api_key) as client:
+        with open(temp_path, "w", encoding="utf-8", newline="") as fh:
+            writer = csv.DictWriter(fh, fieldnames=["id", "prompt", "image_filename", "caption"])
+            writer.writeheader()
 
-        if idx % save_interval == 0 or idx == len(png_files):
-            temp_df = pd.DataFrame(records)
-            temp_path = os.path.join(output_dir, f"{model_name}_captions_temp.csv")
-            temp_df.to_csv(temp_path, index=False)
-            print(f"Auto-saved {len(records)} records to: {temp_path}")
+            if use_batch_api:
+                results = caption_batch(client, model_name, pending)
+            else:
+                results = caption_live(client, model_name, pending)
 
-        time.sleep(1.5)
+            async for record, caption in results:
+                if caption == "":
+                    continue
+                writer.writerow({**record, "caption": caption})
+                fh.flush()
+                saved += 1
 
-    return pd.DataFrame(records)
+    print(f"Saved {saved} records to: {temp_path}")
+    return pd.read_csv(temp_path)
 
 # === STEP 3: Loop through all 4 model folders ===
-# For each model, caption images, sort by ID, and save to final CSV
-for model in model_folders:
-    df_model = process_model_folder(model)
+# For each model, caption images, sort by ID, and save to final CSV.
+# Batch jobs can take hours, so every folder is submitted up front and the jobs are polled together;
+# the live path runs one folder at a time so folders do not compete for the same rate limit.
+# A folder that fails is reported and skipped so the other folders' captions are still saved.
+async def process_all_folders():
+    if use_batch_api:
+        return await asyncio.gather(*[process_model_folder(model) for model in model_folders], return_exceptions=True)
+    results = []
+    for model in model_folders:
+        try:
+            results.append(await process_model_folder(model))
+        except Exception as e:
+            results.append(e)
+    return results
+
+for model, df_model in zip(model_folders, asyncio.run(process_all_folders())):
+    if isinstance(df_model, Exception):
+        print(f"\n[{model}] Folder failed: {df_model!r}")
+        continue
     df_model = df_model.sort_values(by="id").reset_index(drop=True)
     final_path = os.path.join(output_dir, f"{model}_captions_sorted.csv")
     df_model.to_csv(final_path, index=False)
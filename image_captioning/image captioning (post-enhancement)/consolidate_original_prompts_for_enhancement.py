@@ -7,32 +7,38 @@ It extracts and compiles them into a single CSV file sorted by numeric ID, to be
 """
 
 import os
+import re
+import numpy as np
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 
 # === STEP 1: Configuration ===
 # Define input/output paths and ensure output folder exists
 original_folder = "ORIGINAL"  # Folder containing .txt files named 1.txt to 200.txt
 output_csv = "model_outputs/ORIGINAL_prompts.csv"
+max_workers = 32  # Parallel file reads (IO-bound, so threads overlap well)
 os.makedirs(os.path.dirname(output_csv), exist_ok=True)
 
 # === STEP 2: Extract and sort prompts from .txt files ===
 # Read all .txt files, extract text, assign numeric ID, sort, and save to CSV
-data = []
-txt_files = sorted([f for f in os.listdir(original_folder) if f.endswith(".txt")])
-
-for fname in txt_files:
-    file_id = os.path.splitext(fname)[0]
-    txt_path = os.path.join(original_folder, fname)
-
+def read_prompt(fname):
     try:
-        with open(txt_path, "r", encoding="utf-8") as f:
-            prompt = f.read().strip()
-        data.append({"id": file_id, "prompt_original": prompt})
-    except Exception as e:
-        print(f"[{file_id}] Error reading file: {e}")
-
-df = pd.DataFrame(data)
-df["id"] = df["id"].astype(str).str.extract(r"(\d+)").astype(int)
+        with open(os.path.join(original_folder, fname), "r", encoding="utf-8") as f:
+            return f.read().strip()
+    except (OSError, UnicodeDecodeError) as e:
+        print(f"[{os.path.splitext(fname)[0]}] Error reading file: {e}")
+        return None
+
+with os.scandir(original_folder) as it:
+    txt_files = sorted(entry.name for entry in it if entry.name.endswith(".txt"))
+
+with ThreadPoolExecutor(max_workers=max_workers) as ex:
+    prompts = list(ex.map(read_prompt, txt_files))
+
+# Keep readable files only; numeric IDs are parsed from the filenames in the same pass
+kept = [(f, p) for f, p in zip(txt_files, prompts) if p is not None]
+ids = np.fromiter((int(re.search(r"\d+", f).group()) for f, _ in kept), dtype=np.int32, count=len(kept))
+df = pd.DataFrame({"id": ids, "prompt_original": [p for _, p in kept]})
 df = df.sort_values(by="id").reset_index(drop=True)
 
 df.to_csv(output_csv, index=False)
@@ -13,22 +13,30 @@ Final output: civitai_image_prompt_captioned_cleaned.csv
 import os
 import json
 import base64
+import math
 import time
+import asyncio
+import shelve
 import pandas as pd
-from PIL import Image
+from PIL import Image, UnidentifiedImageError
 from io import BytesIO
 from dotenv import load_dotenv
 from tqdm import tqdm
-from openai import OpenAI, RateLimitError
+from openai import AsyncOpenAI, APIError, APIConnectionError, InternalServerError, RateLimitError
 
 # === STEP 0: CONFIGURATION ===
 # Load API key from .env file and set up paths
 load_dotenv()
 api_key = os.getenv("OPENAI_API_KEY")
-client = OpenAI(api_key=api_key)
 
 TARGET_DIR = ""
+MAX_CONCURRENCY = 20  # Number of in-flight GPT-4o-mini requests
+MAX_RETRIES = 3
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, InternalServerError)  # Other API errors (4xx) fail fast
+MAX_REQUESTS_PER_MINUTE = 500  # Match these to the account's GPT-4o-mini limits
+MAX_TOKENS_PER_MINUTE = 200_000
 FINAL_OUTPUT_CSV = os.path.join(TARGET_DIR, "civitai_image_prompt_captioned_cleaned.csv")
+B64_CACHE_PATH = os.path.join(TARGET_DIR, ".b64cache")  # On-disk cache of encoded images, reused across runs
 
 # === STEP 1: EXTRACT PROMPTS FROM JSON ===
 # This step reads all .json files, checks for corresponding .jpg files,
@@ -37,15 +45,21 @@ def extract_prompts():
     seen_prompts = set()
     rows = []
 
-    for filename in os.listdir(TARGET_DIR):
-        if not filename.endswith(".json"):
-            continue
-
+    # One directory scan collects both file types; .jpg presence is then a set lookup rather than a stat call
+    json_files = []
+    jpg_files = set()
+    with os.scandir(TARGET_DIR) as it:
+        for entry in it:
+            if entry.name.endswith(".json"):
+                json_files.append(entry.name)
+            elif entry.name.endswith(".jpg"):
+                jpg_files.add(entry.name)
+
+    for filename in json_files:
         base = filename[:-5]
         json_path = os.path.join(TARGET_DIR, filename)
-        jpg_path = os.path.join(TARGET_DIR, base + ".jpg")
 
-        if not os.path.exists(jpg_path):
+        if base + ".jpg" not in jpg_files:
             continue
 
         with open(json_path, "r", encoding="utf-8") as f:
@@ -62,74 +76,175 @@ def extract_prompts():
     return df
 
 # === STEP 2: ENCODE IMAGE TO BASE64 ===
-# Converts image to base64 PNG format for API submission.
+# Builds a base64 data URL from the raw file bytes for API submission
+# (only formats the API does not accept are re-encoded as PNG).
 # Returns None if image is unreadable or corrupt.
+API_IMAGE_TYPES = {"PNG": "image/png", "JPEG": "image/jpeg", "WEBP": "image/webp"}
+
 def encode_image(image_path):
     try:
-        with Image.open(image_path) as img:
+        with open(image_path, "rb") as f:
+            data = f.read()
+        with Image.open(BytesIO(data)) as img:
+            mime_type = API_IMAGE_TYPES.get(img.format)
+            if mime_type:
+                img.verify()  # Header/chunk check only; the original bytes are sent as-is
+                return f"data:{mime_type};base64,{base64.b64encode(data).decode('utf-8')}"
+            # Formats the API does not accept are re-encoded as PNG
             img = img.convert("RGB")
             buffered = BytesIO()
             img.save(buffered, format="PNG")
-            return base64.b64encode(buffered.getvalue()).decode("utf-8")
-    except Exception:
+            return f"data:image/png;base64,{base64.b64encode(buffered.getvalue()).decode('utf-8')}"
+    except (UnidentifiedImageError, OSError, SyntaxError):  # verify() reports broken chunks as SyntaxError
         return None
 
+# Looks up the encoded image by (filename, mtime, size) before encoding, so re-running the
+# pipeline does not read and encode every image again.
+# The shelve is only touched from the event loop thread; encoding runs in a worker thread.
+async def encode_image_cached(b64_cache, image_path):
+    stat = os.stat(image_path)
+    key = f"{os.path.basename(image_path)}|{stat.st_mtime_ns}|{stat.st_size}"
+    image_url = b64_cache.get(key)
+    if image_url is None:
+        image_url = await asyncio.to_thread(encode_image, image_path)
+        if image_url:
+            b64_cache[key] = image_url
+    return image_url
+
+# === STEP 2.5: RATE LIMITING ===
+# Token bucket that refills request and token capacity continuously at the account's
+# per-minute limits, and only waits (for exactly the shortfall) when either would go negative.
+class RateLimiter:
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.req_rate = requests_per_minute / 60
+        self.tok_rate = tokens_per_minute / 60
+        self.max_req = requests_per_minute
+        self.max_tok = tokens_per_minute
+        self.avail_req = self.max_req
+        self.avail_tok = self.max_tok
+        self.last = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last
+        self.avail_req = min(self.max_req, self.avail_req + elapsed * self.req_rate)
+        self.avail_tok = min(self.max_tok, self.avail_tok + elapsed * self.tok_rate)
+        self.last = now
+
+    async def acquire(self, estimated_tokens):
+        estimated_tokens = min(estimated_tokens, self.max_tok)
+        while True:
+            self._refill()
+            if self.avail_req >= 1 and self.avail_tok >= estimated_tokens:
+                self.avail_req -= 1
+                self.avail_tok -= estimated_tokens
+                return
+            await asyncio.sleep(max(
+                (1 - self.avail_req) / self.req_rate,
+                (estimated_tokens - self.avail_tok) / self.tok_rate
+            ))
+
+# GPT-4o-mini bills images by 512px tiles after resizing to fit 2048x2048 and then
+# to a shortest side of 768px, so the estimate comes from the image size, not its byte size.
+IMAGE_BASE_TOKENS = 2833
+IMAGE_TILE_TOKENS = 5667
+TEXT_TOKENS = 150  # Instruction plus the max_tokens=100 reply
+
+def estimate_tokens(image_path):
+    try:
+        with Image.open(image_path) as img:  # Reads the header only
+            width, height = img.size
+    except (UnidentifiedImageError, OSError):
+        width, height = 2048, 2048
+    scale = min(1, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    tiles = math.ceil(width / 512) * math.ceil(height / 512)
+    return IMAGE_BASE_TOKENS + IMAGE_TILE_TOKENS * tiles + TEXT_TOKENS
+
 # === STEP 3: CAPTION IMAGES AND FILTER BAD ONES ===
-# Iterates through the DataFrame, encodes each image, sends it to OpenAI,
-# retrieves a caption, and filters out any corrupted images.
-# Final CSV is written after excluding all failed or unreadable images.
-def generate_captions(df):
-    records = []
+# Encodes each image and sends it to OpenAI concurrently (bounded by a semaphore and the rate limiter),
+# retrying rate-limited, connection and 5xx errors with exponential backoff, and skips any corrupted images.
+# Final CSV contains only successfully captioned images.
+async def caption_one(client, sem, limiter, b64_cache, image_path):
+    async with sem:
+        try:
+            image_url = await encode_image_cached(b64_cache, image_path)
+        except OSError:
+            return None
+        if not image_url:
+            return None
+
+        estimated_tokens = estimate_tokens(image_path)
+        for attempt in range(MAX_RETRIES):
+            await limiter.acquire(estimated_tokens)
+            try:
+                response = await client.chat.completions.create(
+                    model="gpt-4o-mini",
+                    messages=[
+                        {"role": "user", "content": [
+                            {"type": "text", "text": "Describe this image briefly, including the subject(s) and visual details. Use one clear sentence."},
+                            {"type": "image_url", "image_url": {"url": image_url}}
+                        ]}
+                    ],
+                    max_tokens=100
+                )
+                content = response.choices[0].message.content
+                return content.strip() if content else None
+            except RETRYABLE_ERRORS:
+                if attempt + 1 < MAX_RETRIES:
+                    await asyncio.sleep(2 ** attempt)  # Backoff: 1s, 2s
+            except APIError:
+                return None
+        return None
+
+async def generate_captions(df):
     fail_count = 0
     max_failures = 10
     bad_files = set()
 
     print(f"Starting captioning for {len(df)} images...")
-    for index, row in tqdm(df.iterrows(), total=len(df)):
-        image_file = row["image_filename"]
-        image_path = os.path.join(TARGET_DIR, image_file)
-
-        b64_image = encode_image(image_path)
-        if not b64_image:
-            records.append([row["id"], row["prompt"], image_file, None])
-            bad_files.add(image_file)
-            fail_count += 1
-            if fail_count >= max_failures:
-                print("Too many failures. Exiting early.")
-                break
+    sem = asyncio.Semaphore(MAX_CONCURRENCY)
+    limiter = RateLimiter(MAX_REQUESTS_PER_MINUTE, MAX_TOKENS_PER_MINUTE)
+    async with AsyncOpenAI(api_key=api_key) as client:
+        with shelve.open(B64_CACHE_PATH) as b64_cache:
+            rows = list(df.itertuples(index=False))
+            tasks = [
+                asyncio.ensure_future(caption_one(client, sem, limiter, b64_cache, os.path.join(TARGET_DIR, row.image_filename)))
+                for row in rows
+            ]
+            for task in tqdm(asyncio.as_completed(tasks), total=len(tasks)):
+                if await task is None:
+                    fail_count += 1
+                    if fail_count >= max_failures:
+                        print("Too many failures. Exiting early.")
+                        break
+
+            # After an early stop, unfinished requests are cancelled but finished captions are kept
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    # Records follow extraction order; failed or unreadable images are never recorded, so no post-filter is needed
+    records = []
+    for row, task in zip(rows, tasks):
+        if task.cancelled():
             continue
-
-        try:
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "user", "content": [
-                        {"type": "text", "text": "Describe this image briefly, including the subject(s) and visual details. Use one clear sentence."},
-                        {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{b64_image}"}}
-                    ]}
-                ],
-                max_tokens=100
-            )
-            caption = response.choices[0].message.content.strip()
-            records.append([row["id"], row["prompt"], image_file, caption])
-            time.sleep(16)  # Rate limit buffer
-        except RateLimitError:
-            time.sleep(5)
+        caption = task.result() if task.exception() is None else None
+        if caption is None:
+            bad_files.add(row.image_filename)
             continue
-        except Exception:
-            records.append([row["id"], row["prompt"], image_file, None])
-            bad_files.add(image_file)
-            fail_count += 1
-            if fail_count >= max_failures:
-                break
+        records.append([row.id, row.prompt, row.image_filename, caption])
 
     df_out = pd.DataFrame(records, columns=["id", "prompt", "image_filename", "caption"])
-    df_out = df_out[~df_out["image_filename"].isin(bad_files)]
     df_out.to_csv(FINAL_OUTPUT_CSV, index=False)
     print(f"Saved cleaned captioned CSV: {FINAL_OUTPUT_CSV}")
+    print(f"Skipped {len(bad_files)} failed or unreadable images.")
 
 # === MAIN EXECUTION ===
 # Extract prompts from metadata and generate captions.
 if __name__ == "__main__":
     df_prompts = extract_prompts()
-    generate_captions(df_prompts)
\ No newline at end of file
+    asyncio.run(generate_captions(df_prompts))
\ No newline at end of file
@@ -16,106 +16,192 @@ It performs the following steps:
 
 import os
 import base64
+import asyncio
+import shelve
+import aiohttp
 import pandas as pd
-import requests
-from PIL import Image
+import pyarrow as pa
+import pyarrow.parquet as pq
+from PIL import Image, UnidentifiedImageError
 from io import BytesIO
 from tqdm import tqdm
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import AsyncOpenAI, APIError, APIConnectionError, InternalServerError, RateLimitError
 
 # === STEP 0: CONFIGURATION ===
 # Load API key and define folders and file paths
 load_dotenv()
 api_key = os.getenv("OPENAI_API_KEY")
-client = OpenAI(api_key=api_key)
 
 data_folder = ""
 image_folder = ""
 output_csv = ""
 max_consecutive_fails = 20
+parquet_batch_size = 1024  # Rows materialised per parquet read
+max_download_concurrency = 64  # Number of in-flight image downloads (and pooled connections)
+download_retries = 3
+download_backoff = 0.5  # Seconds; doubles after each retry
+RETRY_STATUSES = {429, 500, 502, 503, 504}
 max_api_failures = 10
+max_concurrency = 20  # Number of in-flight GPT-4o-mini requests
+max_retries = 3
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, InternalServerError)  # Other API errors (4xx) fail fast
+b64_cache_path = os.path.join(image_folder, ".b64cache")  # On-disk cache of encoded images, reused across resumed runs
 
 os.makedirs(image_folder, exist_ok=True)
 
 # === STEP 1: EXTRACT PROMPTS & DOWNLOAD IMAGES FROM PARQUET ===
-# Parses each .parquet file to collect prompt + image reference, then downloads valid images
+# Streams each .parquet file in row batches to collect prompt + image reference, then downloads valid images concurrently
 # Skips corrupted or unsupported formats, and validates that images are readable
 
-def extract_and_download():
-    records = []
-    id_counter = 1
-    consecutive_fails = 0
-    parquet_files = [f for f in os.listdir(data_folder) if f.endswith(".parquet")]
+SUPPORTED_EXTS = ["jpg", "jpeg", "png", "webp"]
+PARQUET_COLUMNS = ["text", "prompt", "image", "url"]
 
-    for file in parquet_files:
-        full_path = os.path.join(data_folder, file)
-        print(f"\nProcessing {file}...")
+def url_extension(img_url):
+    return img_url.split('.')[-1].split('?')[0][:4].lower()
 
-        try:
-            df = pd.read_parquet(full_path)
-        except Exception as e:
-            print(f"Failed to read {file}: {e}")
-            continue
+# Reads one batch column as plain Python values. Image structs (e.g. struct<bytes, path>) contribute
+# their `bytes` child directly, falling back to a `url` child, so no per-row dict is built
+def column_values(batch, name):
+    if name not in batch.schema.names:
+        return [None] * batch.num_rows
 
-        if df.empty:
-            print(f"Skipping {file} (empty DataFrame)")
-            continue
+    column = batch.column(name)
+    if not pa.types.is_struct(column.type):
+        return column.to_pylist()
 
-        for _, row in tqdm(df.iterrows(), total=len(df), desc=f"Rows in {file}"):
-            try:
-                prompt = row.get("text") or row.get("prompt")
-                img_data = row.get("image") or row.get("url")
+    # flatten() applies the struct's own null mask to each child
+    children = {column.type.field(i).name: child for i, child in enumerate(column.flatten())}
+    img_bytes = children["bytes"].to_pylist() if "bytes" in children else [None] * batch.num_rows
+    img_urls = children["url"].to_pylist() if "url" in children else [None] * batch.num_rows
+    return [b if b is not None else u for b, u in zip(img_bytes, img_urls)]
 
-                if not prompt or not img_data:
-                    continue
+# Returns (prompt, img_bytes, img_url, img_ext), or None for rows that should be skipped
+def parse_row(prompt, img_data):
+    if not prompt or not img_data:
+        return None
 
-                img_id = f"img_{id_counter:07d}"
-                img_ext = "jpg"
-                img_bytes = None
+    if isinstance(img_data, bytes):
+        return prompt, img_data, None, "png"
 
-                if isinstance(img_data, dict) and "bytes" in img_data:
-                    img_bytes = img_data["bytes"]
-                    img_ext = "png"
+    if not isinstance(img_data, str):
+        return None
 
-                elif isinstance(img_data, dict) and "url" in img_data:
-                    img_url = img_data["url"]
-                    if isinstance(img_url, str):
-                        img_ext = img_url.split('.')[-1].split('?')[0][:4].lower()
-                        if img_ext not in ["jpg", "jpeg", "png", "webp"]:
-                            continue
-                        response = requests.get(img_url, timeout=10)
+    img_ext = url_extension(img_data)
+    if img_ext not in SUPPORTED_EXTS:
+        return None
+    return prompt, None, img_data, img_ext
+
+# Yields row batches, stopping at the first unreadable row group so a corrupt file
+# is logged and skipped instead of aborting the run
+def read_batches(parquet_file, file, columns):
+    try:
+        yield from parquet_file.iter_batches(batch_size=parquet_batch_size, columns=columns)
+    except (OSError, pa.ArrowInvalid) as e:
+        print(f"Failed to read {file}: {e}")
+
+# Downloads reuse the session's pooled keep-alive connections; throttling and
+# transient server errors, dropped connections and timeouts are retried with exponential backoff.
+# The response is released before sleeping so a backing-off download does not hold a pooled connection
+async def download_image(session, sem, img_url):
+    async with sem:
+        for attempt in range(download_retries + 1):
+            try:
+                async with session.get(img_url, timeout=aiohttp.ClientTimeout(total=10)) as response:
+                    if response.status not in RETRY_STATUSES:
                         response.raise_for_status()
-                        img_bytes = response.content
+                        return await response.read()
+            except aiohttp.ClientResponseError:
+                return None  # Non-retryable HTTP status (e.g. 404)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                pass
+
+            if attempt < download_retries:
+                await asyncio.sleep(download_backoff * 2 ** attempt)
+        return None
 
-                elif isinstance(img_data, str):
-                    img_url = img_data
-                    img_ext = img_url.split('.')[-1].split('?')[0][:4].lower()
-                    if img_ext not in ["jpg", "jpeg", "png", "webp"]:
-                        continue
-                    response = requests.get(img_url, timeout=10)
-                    response.raise_for_status()
-                    img_bytes = response.content
+# Verifies in memory so corrupt images are never written to disk; returns False for invalid bytes
+def store_image(img_bytes, img_path):
+    try:
+        with Image.open(BytesIO(img_bytes)) as test_img:
+            test_img.verify()
+    except (UnidentifiedImageError, OSError, SyntaxError):
+        return False
 
-                else:
-                    continue
+    with open(img_path, 'wb') as f:
+        f.write(img_bytes)
+    return True
 
-                if img_bytes:
-                    img_filename = f"{img_id}.{img_ext}"
-                    img_path = os.path.join(image_folder, img_filename)
+async def load_image_bytes(session, sem, img_bytes, img_url):
+    if img_url is None:
+        return img_bytes
+    return await download_image(session, sem, img_url)
 
-                    if os.path.exists(img_path):
-                        id_counter += 1
-                        continue
+async def extract_and_download():
+    records = []
+    id_counter = 1
+    consecutive_fails = 0
+    parquet_files = [f for f in os.listdir(data_folder) if f.endswith(".parquet")]
+    sem = asyncio.Semaphore(max_download_concurrency)
+    existing = set(os.listdir(image_folder))  # One listing up front instead of a stat per row on resume
 
-                    with open(img_path, 'wb') as f:
-                        f.write(img_bytes)
+    connector = aiohttp.TCPConnector(limit=max_download_concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        for file in parquet_files:
+            full_path = os.path.join(data_folder, file)
+            print(f"\nProcessing {file}...")
+
+            try:
+                parquet_file = pq.ParquetFile(full_path)
+            except (OSError, pa.ArrowInvalid) as e:
+                print(f"Failed to read {file}: {e}")
+                continue
+
+            if parquet_file.metadata.num_rows == 0:
+                print(f"Skipping {file} (empty file)")
+                continue
+
+            columns = [c for c in PARQUET_COLUMNS if c in parquet_file.schema_arrow.names]
+            progress = tqdm(total=parquet_file.metadata.num_rows, desc=f"Rows in {file}")
+
+            for batch in read_batches(parquet_file, file, columns):
+                prompts = [t or p for t, p in zip(column_values(batch, "text"), column_values(batch, "prompt"))]
+                images = [i or u for i, u in zip(column_values(batch, "image"), column_values(batch, "url"))]
+                rows = [parsed for parsed in map(parse_row, prompts, images) if parsed]
+                results = await asyncio.gather(*[
+                    load_image_bytes(session, sem, img_bytes, img_url) for _, img_bytes, img_url, _ in rows
+                ], return_exceptions=True)
+
+                # Results are handled in row order so image IDs stay stable across resumed runs
+                for (prompt, _, _, img_ext), img_bytes in zip(rows, results):
+                    img_id = f"img_{id_counter:07d}"
+                    img_filename = f"{img_id}.{img_ext}"
 
+                    # Single per-row handler: any unexpected error (e.g. PIL's DecompressionBombError)
+                    # counts as a failed row instead of aborting the extraction
                     try:
-                        with Image.open(img_path) as test_img:
-                            test_img.verify()
-                    except Exception:
-                        os.remove(img_path)
+                        if isinstance(img_bytes, Exception):
+                            raise img_bytes
+                        if not img_bytes:
+                            failed = True
+                        elif img_filename in existing:
+                            # Downloaded by an earlier run; kept in the dataset so caption_images
+                            # can caption it if that run stopped before doing so
+                            failed = False
+                        elif store_image(img_bytes, os.path.join(image_folder, img_filename)):
+                            existing.add(img_filename)
+                            failed = False
+                        else:
+                            continue
+                    except Exception as e:
+                        print(f"[{img_id}] Skipping row: {e}")
+                        failed = True
+
+                    if failed:
+                        consecutive_fails += 1
+                        if consecutive_fails >= max_consecutive_fails:
+                            print(f"Aborting: {max_consecutive_fails} consecutive failures.")
+                            break
                         continue
 
                     records.append({
@@ -126,38 +212,88 @@ def extract_and_download():
 
                     id_counter += 1
                     consecutive_fails = 0
-                else:
-                    consecutive_fails += 1
 
-            except Exception:
-                consecutive_fails += 1
+                progress.update(batch.num_rows)
                 if consecutive_fails >= max_consecutive_fails:
-                    print(f"Aborting: {max_consecutive_fails} consecutive failures.")
                     break
 
-        if consecutive_fails >= max_consecutive_fails:
-            break
+            progress.close()
+            if consecutive_fails >= max_consecutive_fails:
+                break
 
     return pd.DataFrame(records)
 
 # === STEP 2: ENCODE IMAGE TO BASE64 ===
-# Converts a valid image into a base64-encoded PNG string
+# Converts a valid image into a base64 data URL, sending the original bytes
+# and only re-encoding to PNG for formats the API does not accept
+
+API_IMAGE_TYPES = {"PNG": "image/png", "JPEG": "image/jpeg", "WEBP": "image/webp"}
 
 def encode_image(image_path):
     try:
-        with Image.open(image_path) as img:
+        with open(image_path, "rb") as f:
+            data = f.read()
+        with Image.open(BytesIO(data)) as img:
+            mime_type = API_IMAGE_TYPES.get(img.format)
+            if mime_type:
+                img.verify()  # Header/chunk check only; the original bytes are sent as-is
+                return f"data:{mime_type};base64,{base64.b64encode(data).decode('utf-8')}"
+            # Formats the API does not accept are re-encoded as PNG
             img = img.convert("RGB")
             buffered = BytesIO()
             img.save(buffered, format="PNG")
-            return base64.b64encode(buffered.getvalue()).decode("utf-8")
-    except Exception:
+            return f"data:image/png;base64,{base64.b64encode(buffered.getvalue()).decode('utf-8')}"
+    except (UnidentifiedImageError, OSError, SyntaxError):  # verify() reports broken chunks as SyntaxError
         return None
 
+# Looks up the encoded image by (filename, mtime, size) before encoding, so images
+# left over from an interrupted run are not read and encoded again.
+# The shelve is only touched from the event loop thread; encoding runs in a worker thread.
+async def encode_image_cached(b64_cache, image_path):
+    stat = os.stat(image_path)
+    key = f"{os.path.basename(image_path)}|{stat.st_mtime_ns}|{stat.st_size}"
+    image_url = b64_cache.get(key)
+    if image_url is None:
+        image_url = await asyncio.to_thread(encode_image, image_path)
+        if image_url:
+            b64_cache[key] = image_url
+    return image_url
+
 # === STEP 3: GENERATE IMAGE CAPTIONS USING GPT-4o ===
 # Checks for existing captioned rows to resume automatically.
-# Sends base64-encoded image to GPT-4o-mini and stores the caption.
+# Encodes and sends images to GPT-4o-mini concurrently (bounded by a semaphore) and stores the captions.
 
-def caption_images(df):
+async def caption_one(client, sem, b64_cache, image_path):
+    async with sem:
+        try:
+            image_url = await encode_image_cached(b64_cache, image_path)
+        except OSError:
+            return None
+        if not image_url:
+            return None
+
+        for attempt in range(max_retries):
+            try:
+                response = await client.chat.completions.create(
+                    model="gpt-4o-mini",
+                    messages=[
+                        {"role": "user", "content": [
+                            {"type": "text", "text": "Describe this image briefly, including the subject(s) and visual details. Use one clear sentence."},
+                            {"type": "image_url", "image_url": {"url": image_url}}
+                        ]}
+                    ],
+                    max_tokens=100
+                )
+                content = response.choices[0].message.content
+                return content.strip() if content else None
+            except RETRYABLE_ERRORS:
+                if attempt + 1 < max_retries:
+                    await asyncio.sleep(2 ** attempt)  # Backoff: 1s, 2s
+            except APIError:
+                return None
+        return None
+
+async def caption_images(df):
     existing_captions = set()
     if os.path.exists(output_csv):
         df_existing = pd.read_csv(output_csv)
@@ -171,42 +307,45 @@ def caption_images(df):
         print("All images already captioned.")
         return
 
-    records = []
     fail_count = 0
+    sem = asyncio.Semaphore(max_concurrency)
 
     print(f"Starting captioning for {len(df)} images...")
-    for index, row in tqdm(df.iterrows(), total=len(df)):
-        image_file = row["image_filename"]
-        image_path = os.path.join(image_folder, image_file)
+    async with AsyncOpenAI(api_key=api_key) as client:
+        with shelve.open(b64_cache_path) as b64_cache:
+            rows = []
+            tasks = []
+            for row in df.itertuples(index=False):
+                image_path = os.path.join(image_folder, row.image_filename)
+
+                if not os.path.exists(image_path):
+                    continue
 
-        if not os.path.exists(image_path):
-            continue
+                rows.append(row)
+                tasks.append(asyncio.ensure_future(caption_one(client, sem, b64_cache, image_path)))
 
-        b64_image = encode_image(image_path)
-        if not b64_image:
-            fail_count += 1
-            continue
+            for task in tqdm(asyncio.as_completed(tasks), total=len(tasks)):
+                caption = await task
+                if caption is None:
+                    fail_count += 1
+                    if fail_count >= max_api_failures:
+                        print("Too many consecutive API failures. Stopping early.")
+                        break
+                    continue
+                fail_count = 0
 
-        try:
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "user", "content": [
-                        {"type": "text", "text": "Describe this image briefly, including the subject(s) and visual details. Use one clear sentence."},
-                        {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{b64_image}"}}
-                    ]}
-                ],
-                max_tokens=100
-            )
-            caption = response.choices[0].message.content.strip()
-            records.append([row["id"], row["prompt"], image_file, caption])
-            fail_count = 0
-
-        except Exception:
-            fail_count += 1
-            if fail_count >= max_api_failures:
-                print("Too many consecutive API failures. Stopping early.")
-                break
+            # After an early stop, unfinished requests are cancelled but finished captions are kept
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    # Records follow extraction order rather than completion order
+    records = [
+        [row.id, row.prompt, row.image_filename, task.result()]
+        for row, task in zip(rows, tasks)
+        if not task.cancelled() and task.exception() is None and task.result() is not None
+    ]
 
     df_new = pd.DataFrame(records, columns=["id", "prompt", "image_filename", "caption"])
     df_combined = pd.concat([df_existing, df_new], ignore_index=True)
@@ -216,8 +355,8 @@ def caption_images(df):
 # === STEP 4: RUN FULL PIPELINE ===
 # Orchestrates the process from extraction to captioning to export
 if __name__ == "__main__":
-    df = extract_and_download()
+    df = asyncio.run(extract_and_download())
     if df.empty:
         print("No valid images extracted.")
     else:
-        caption_images(df)
\ No newline at end of file
+        asyncio.run(caption_images(df))
\ No newline at end of file